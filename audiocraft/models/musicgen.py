@@ -635,6 +635,8 @@ class MusicGen:
     def generate_audio(self, gen_tokens: torch.Tensor):
         """Generate Audio from tokens"""
         assert gen_tokens.dim() == 3
-        with torch.no_grad():
+        # a fresh autocast, `self.autocast` must not be re-entered while it may still be active
+        with torch.no_grad(), torch.autocast(self.device.type, dtype=torch.float16,
+                                             enabled=self.device.type == 'cuda'):
             gen_audio = self.compression_model.decode(gen_tokens, None)
-        return gen_audio
+        return gen_audio.float()
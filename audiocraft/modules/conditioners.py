@@ -763,6 +763,7 @@ class ChromaChordConditioner(ChromaStemConditioner):
         self.chroma_coefficient = 1
         
         self.continuation_count = 0 # for infinite generation with text chroma
+        self.cached_stems: tp.Optional[torch.Tensor] = None # precomputed demucs stems of the conditioning wav
         #3 Layered MLP projection override
         '''
         self.output_proj = nn.Sequential(
@@ -820,6 +821,22 @@ class ChromaChordConditioner(ChromaStemConditioner):
         dummy_chr = self.chroma(dummy_wav)
         return dummy_chr.shape[1]
 
+    def _get_cached_stems(self, wav: torch.Tensor) -> tp.Optional[torch.Tensor]:
+        """Reuse `cached_stems` for the given wav (at demucs sample rate) if they cover it.
+        Nullified wavs in the batch (e.g. for classifier free guidance) get silent stems.
+        """
+        if self.cached_stems is None:
+            return None
+        stems = self.cached_stems.to(self.device)
+        length = wav.shape[-1]
+        # stems cover a different chunk, e.g. when generating longer than the training duration
+        if abs(stems.shape[-1] - length) > self.demucs.samplerate // 100:  # type: ignore
+            return None
+        stems = F.pad(stems, (0, max(0, length - stems.shape[-1])))[..., :length]
+        stems = stems.expand(wav.shape[0], -1, -1, -1).clone()
+        stems[(wav == 0).flatten(1).all(dim=1)] = 0
+        return stems
+
     @torch.no_grad()
     def _get_stemmed_wav(self, wav: torch.Tensor, sample_rate: int) -> torch.Tensor:
         """Get parts of the wav that holds the melody, extracting the main stems from the wav."""
@@ -828,7 +845,9 @@ class ChromaChordConditioner(ChromaStemConditioner):
         with self.autocast:
             wav = convert_audio(
                 wav, sample_rate, self.demucs.samplerate, self.demucs.audio_channels)  # type: ignore
-            stems = apply_model(self.demucs, wav, device=self.device)
+            stems = self._get_cached_stems(wav)
+            if stems is None:
+                stems = apply_model(self.demucs, wav, device=self.device)
             stems = stems[:, self.stem_indices]  # extract relevant stems for melody conditioning
             mix_wav = stems.sum(1)  # merge extracted stems to single waveform
             mix_wav = convert_audio(mix_wav, self.demucs.samplerate, self.sample_rate, 1)  # type: ignore
@@ -1,14 +1,20 @@
 # Prediction interface for Cog ⚙️
 # https://github.com/replicate/cog/blob/main/docs/python.md
 
+import gc
 import os
 import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # We need to set `TRANSFORMERS_CACHE` before any imports, which is why this is up here.
 MODEL_PATH = "/src/models/"
 os.environ["TRANSFORMERS_CACHE"] = MODEL_PATH
 os.environ["TORCH_HOME"] = MODEL_PATH
 
+MODEL_VERSIONS = ["stereo-chord", "stereo-chord-large", "chord", "chord-large"]
+
 from typing import Optional
 from cog import BasePredictor, Input, Path
 
@@ -20,6 +26,7 @@ import typing as tp
 import numpy as np
 
 import torch
+from torch import nn
 
 from audiocraft.models import MusicGen, MultiBandDiffusion
 from audiocraft.solvers.compression import CompressionSolver
@@ -32,14 +39,11 @@ from audiocraft.data.audio import audio_write
 from audiocraft.models.builders import get_lm_model
 from omegaconf import OmegaConf
 
-import librosa
-
-import subprocess
 import math
 
 from BeatNet.BeatNet import BeatNet
 import allin1
-import pytsmod as tsm
+from numba import njit, prange
 
 def _delete_param(cfg, full_name: str):
     parts = full_name.split('.')
@@ -53,7 +57,90 @@ def _delete_param(cfg, full_name: str):
         del cfg[parts[-1]]
     OmegaConf.set_struct(cfg, True)
 
-def load_ckpt(path, device, url=False):
+@njit(parallel=True, fastmath=True)
+def _wsola_numba(x, ana_pos, syn_pos, win, syn_hop, tolerance, output_length):
+    win_size = win.shape[0]
+    y = np.zeros(output_length + 2 * win_size)
+    ow = np.zeros(output_length + 2 * win_size)
+    n_lags = 2 * tolerance + 1
+    corr = np.zeros(n_lags)
+    delta = 0
+    for i in range(len(ana_pos)):
+        start = ana_pos[i] + delta
+        for j in range(win_size):
+            y[syn_pos[i] + j] += x[start + j] * win[j]
+            ow[syn_pos[i] + j] += win[j]
+        if i == len(ana_pos) - 1:
+            break
+        # find the offset around the next analysis frame that best continues the natural progression
+        nat_start = start + syn_hop
+        next_start = ana_pos[i + 1] - tolerance
+        for lag in prange(n_lags):
+            acc = 0.0
+            for j in range(win_size):
+                acc += x[nat_start + j] * x[next_start + lag + j]
+            corr[lag] = acc
+        delta = tolerance - np.argmax(corr[::-1])
+    for j in range(ow.shape[0]):
+        if ow[j] < 1e-3:
+            ow[j] = 1
+    return (y / ow)[win_size // 2: win_size // 2 + output_length]
+
+
+def _wsola(x, anchors, win_size=1024, syn_hop=512, tolerance=512):
+    """WSOLA time stretching, drop-in for `pytsmod.wsola` with a hann window.
+
+    Args:
+        x (np.ndarray): audio of shape [C, T] or [T].
+        anchors (np.ndarray): anchor points of shape [2, N], source positions in the
+            first row and target positions in the second one.
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    anchors = np.asarray(anchors, dtype=np.float64)
+    output_length = int(anchors[1, -1]) + 1
+    win = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(win_size) / win_size)  # periodic hann
+
+    syn_pos = np.arange(0, output_length + win_size // 2, syn_hop)
+    # linear interpolation of the analysis positions, extrapolated past the last anchor
+    ana_pos = np.interp(syn_pos, anchors[1], anchors[0])
+    slope = (anchors[0, -1] - anchors[0, -2]) / max(anchors[1, -1] - anchors[1, -2], 1)
+    past_end = syn_pos > anchors[1, -1]
+    ana_pos[past_end] = anchors[0, -1] + (syn_pos[past_end] - anchors[1, -1]) * slope
+    ana_pos = np.round(ana_pos).astype(np.int64)
+
+    ana_hop = np.diff(ana_pos)
+    min_fac = np.min(syn_hop / np.maximum(ana_hop, 1))
+    left_pad = win_size // 2 + tolerance
+    right_pad = int(np.ceil(1 / min_fac)) * win_size + tolerance
+    x = np.pad(x, ((0, 0), (left_pad, right_pad)))
+    ana_pos = ana_pos + tolerance
+
+    return np.stack([
+        _wsola_numba(chan, ana_pos, syn_pos, win, syn_hop, tolerance, output_length) for chan in x
+    ]).squeeze()
+
+
+def replace_linear_with_4bit(module, compute_dtype=torch.float16, quant_type='nf4'):
+    """Swap every `nn.Linear` in `module` for a bitsandbytes 4-bit linear, quantized on its device.
+    `nn.MultiheadAttention` is left untouched as it reads `out_proj.weight` directly.
+    """
+    from bitsandbytes.nn import Linear4bit, Params4bit
+    for name, child in module.named_children():
+        if isinstance(child, nn.MultiheadAttention):
+            continue
+        if isinstance(child, nn.Linear):
+            device = child.weight.device
+            qlinear = Linear4bit(child.in_features, child.out_features, bias=child.bias is not None,
+                                 compute_dtype=compute_dtype, quant_type=quant_type)
+            qlinear.weight = Params4bit(child.weight.data.cpu(), requires_grad=False, quant_type=quant_type)
+            if child.bias is not None:
+                qlinear.bias = nn.Parameter(child.bias.data.cpu(), requires_grad=False)
+            # the weights are quantized when moved to the GPU
+            setattr(module, name, qlinear.to(device))
+        else:
+            replace_linear_with_4bit(child, compute_dtype=compute_dtype, quant_type=quant_type)
+
+def load_ckpt(path, device, url=False, quantize=False):
     if url:
         loaded = torch.hub.load_state_dict_from_url(str(path))
     else:
@@ -72,6 +159,9 @@ def load_ckpt(path, device, url=False):
     lm = get_lm_model(loaded['xp.cfg'])
     lm.load_state_dict(loaded['model']) 
     lm.eval()
+    if quantize and cfg.device != 'cpu':
+        # Only the transformer is quantized, conditioners and output heads stay in half precision
+        replace_linear_with_4bit(lm.transformer, compute_dtype=torch.float16, quant_type='nf4')
     lm.cfg = cfg
     compression_model = CompressionSolver.model_from_checkpoint(cfg.compression_model_checkpoint, device=device)
     return MusicGen(f"{os.getenv('COG_USERNAME')}/musicgen-chord", compression_model, lm)
@@ -80,8 +170,27 @@ class Predictor(BasePredictor):
     def setup(self, weights: Optional[Path] = None):
         """Load the model into memory to make running multiple predictions efficient"""
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-
-        self.mbd = MultiBandDiffusion.get_mbd_musicgen()
+        torch.backends.cudnn.benchmark = True
+
+        self.mbd = None
+        self.model = None
+        self._loaded_version = None
+        self._model_cache = {}
+        self._chord_cache = {}
+        self._model_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._resamplers = {}
+        self._stem_idxs = None
+
+        # Fetching the weights of every model version up front, off the prediction path.
+        # A failed download raises here and fails setup for the whole worker, not just that version.
+        with ThreadPoolExecutor(len(MODEL_VERSIONS)) as ex:
+            list(ex.map(self._ensure_weights, MODEL_VERSIONS))
+
+        # Warm up the default model in the background so the first prediction doesn't pay for it
+        self._warmup_key = ("stereo-chord", False)
+        self._warmup_thread = threading.Thread(target=self._warmup, args=self._warmup_key, daemon=True)
+        self._warmup_thread.start()
 
     def _load_model(
         self,
@@ -102,11 +211,82 @@ class Predictor(BasePredictor):
         
         return MusicGen(model_id, compression_model, lm)
 
+    def _get_mbd(self) -> MultiBandDiffusion:
+        # MBD is only usable with the mono models and off by default, so it's loaded on first use
+        if self.mbd is None:
+            self.mbd = MultiBandDiffusion.get_mbd_musicgen(device=self.device)
+        return self.mbd
+
+    def _ensure_weights(self, model_version: str) -> str:
+        dest = f"/src/musicgen-{model_version}.th"
+        if not os.path.isfile(dest):
+            url = f"https://weights.replicate.delivery/default/musicgen-chord/musicgen-{model_version}.th"
+            torch.hub.download_url_to_file(url, dest, progress=False)
+        return dest
+
+    def _evict_models(self):
+        self._model_cache.clear()
+        self._chord_cache.clear()
+        self.model = None
+        self._loaded_version = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _build_model(self, model_version: str, quantize: bool = False) -> MusicGen:
+        path = self._ensure_weights(model_version)
+        model = load_ckpt(path, self.device, quantize=quantize)
+        model.lm.condition_provider.conditioners['self_wav'].match_len_on_eval = True
+        return model
+
+    def _cache_model(self, model_version: str, quantize: bool, model: MusicGen):
+        self._model_cache[(model_version, quantize)] = model
+        # Keep the default (large vocab) chord model around so it can be restored later
+        self._chord_cache[(model_version, True)] = self._get_chord_state(model)
+
+    def _analyze(self, input_path: Path, audio: torch.Tensor, sr: int, work_dir: str):
+        # allin1 only accepts paths, compressed inputs are handed over as a PCM wav written here,
+        # off the prediction path. `.wav` inputs are passed as-is and decoded a second time by allin1.
+        analysis_path = str(input_path)
+        if input_path.suffix.lower() != '.wav':
+            analysis_path = os.path.join(work_dir, input_path.stem + '.wav')
+            torchaudio.save(analysis_path, audio, sr)
+        return allin1.analyze(
+            analysis_path,
+            demix_dir=os.path.join(work_dir, 'demix'),
+            spec_dir=os.path.join(work_dir, 'spec'),
+        )
+
+    def _warmup(self, model_version: str, quantize: bool = False):
+        # Built without holding the lock, so a first request for another version doesn't wait for it
+        model = self._build_model(model_version, quantize)
+        with self._model_lock:
+            # Only published if no prediction has loaded a model meanwhile, the warm model is dropped otherwise
+            if not self._model_cache:
+                self._cache_model(model_version, quantize, model)
+                return
+        del model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _get_model(self, model_version: str, quantize: bool = False) -> MusicGen:
+        key = (model_version, quantize)
+        if key == self._warmup_key and self._warmup_thread.is_alive():
+            # Waiting for the warmup is cheaper than loading the same version twice
+            self._warmup_thread.join()
+        with self._model_lock:
+            if key not in self._model_cache:
+                # Only the last used version stays resident, the variants don't fit in VRAM together
+                self._evict_models()
+                self._cache_model(model_version, quantize, self._build_model(model_version, quantize))
+            return self._model_cache[key]
+
     def predict(
         self,
         model_version: str = Input(
             description="Model type. Computations take longer when using `large` or `stereo` models.", default="stereo-chord",
-            choices=["stereo-chord", "stereo-chord-large", "chord", "chord-large"]
+            choices=MODEL_VERSIONS
         ),
         prompt: str = Input(
             description="A description of the music you want to generate.", default=None
@@ -170,6 +350,14 @@ class Predictor(BasePredictor):
             description="Seed for random number generator. If `None` or `-1`, a random seed will be used.",
             default=None,
         ),
+        deterministic: bool = Input(
+            description="If `True`, cuDNN is forced to use deterministic algorithms so that a fixed `seed` reproduces the same output. This makes the predictions slower.",
+            default=False,
+        ),
+        quantize_large: bool = Input(
+            description="If `True`, `large` models are loaded with 4-bit (nf4) transformer weights to use less GPU memory. This may affect the output quality.",
+            default=False,
+        ),
         # overlap: int = Input(
         #     description="The length of overlapping part. Last `overlap` seconds of previous generation output audio is given to the next generation's audio prompt for continuation. (This will be fixed with the optimal value and be hidden, when releasing.)",
         #     default=5, le=15, ge=1
@@ -188,6 +376,8 @@ class Predictor(BasePredictor):
             raise ValueError("Must provide `prompt`.")
         if not music_input:
             raise ValueError("Must provide `music_input`.")
+        if multi_band_diffusion and 'stereo' in model_version:
+            raise ValueError("Multi-band Diffusion only works with non-stereo models.")
         
         if prompt is None:
             prompt = ''
@@ -198,69 +388,61 @@ class Predictor(BasePredictor):
         #     shutil.rmtree(tmp_path)
         # os.mkdir(tmp_path)
 
-        if os.path.isdir('demix'):
-            import shutil
-            shutil.rmtree('demix')
-        if os.path.isdir('spec'):
-            import shutil
-            shutil.rmtree('spec')
+        # Per-request scratch space for allin1, so concurrent predictions don't share `demix`/`spec`
+        analysis_dir = tempfile.TemporaryDirectory()
+        fut_analysis = None
+        try:
+            # Decoding the input once for the pipeline, allin1 still decodes its own copy of the file
+            input_path = Path(music_input)
+            music_input, sr = torchaudio.load(str(input_path))
+
+            # Music Structure Analysis runs on a worker thread while the model is loading
+            fut_analysis = self._executor.submit(
+                self._analyze, input_path, music_input, sr, analysis_dir.name,
+            )
+
+            # Loading models
+            model_key = (model_version, quantize_large and 'large' in model_version)
+            if model_key != self._loaded_version:
+                self.model = self._get_model(*model_key)
+                self._loaded_version = model_key
+            # Loaded outside of inference mode so its parameters aren't created as inference tensors
+            mbd = self._get_mbd() if multi_band_diffusion else None
+
+            if 'stereo' in model_version:
+                channel = 2
+            else:
+                channel = 1
 
-        # Loading models
-        if os.path.isfile(f'musicgen-{model_version}.th'):
-                pass
-        else:
-            url = f"https://weights.replicate.delivery/default/musicgen-chord/musicgen-{model_version}.th"
-            dest = f"/src/musicgen-{model_version}.th"
-            subprocess.check_call(["pget", url, dest], close_fds=False)
-        self.model = load_ckpt(f'/src/musicgen-{model_version}.th', self.device)
-        self.model.lm.condition_provider.conditioners['self_wav'].match_len_on_eval = True
+            self._set_chord_vocab(model_version, large_chord_voca)
 
-        if 'stereo' in model_version:
-            channel = 2
-        else:
-            channel = 1
+            model = self.model
+            model.lm.eval()
+            sw = model.lm.condition_provider.conditioners['self_wav']
 
-        if large_chord_voca is False:
-            # Switching Chord Prediction model to 25 vocab (smaller)
-            from audiocraft.modules.btc.btc_model import BTC_model
-            from audiocraft.modules.btc.utils.mir_eval_modules import idx2chord
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.config.feature['large_voca']=False
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.config.model['num_chords']=25
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.model_file='audiocraft/modules/btc/test/btc_model.pt'
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.idx_to_chord = idx2chord
-            loaded = torch.load('audiocraft/modules/btc/test/btc_model.pt')
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.mean = loaded['mean']
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.std = loaded['std']
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.model = BTC_model(config=self.model.lm.condition_provider.conditioners['self_wav'].chroma.config.model).to(self.device)
-            self.model.lm.condition_provider.conditioners['self_wav'].chroma.model.load_state_dict(loaded['model'])
-            
-        model = self.model
-        model.lm.eval()
+            # in_step_beat_sync = in_step_beat_sync
 
-        if multi_band_diffusion and int(self.model.lm.cfg.transformer_lm.n_q) == 8:
-            raise ValueError("Multi-band Diffusion only works with non-stereo models.")
-        
-        # in_step_beat_sync = in_step_beat_sync
-
-        set_generation_params = lambda duration: model.set_generation_params(
-            duration=duration,
-            top_k=top_k,
-            top_p=top_p,
-            temperature=temperature,
-            cfg_coef=classifier_free_guidance,
-        )
+            set_generation_params = lambda duration: model.set_generation_params(
+                duration=duration,
+                top_k=top_k,
+                top_p=top_p,
+                temperature=temperature,
+                cfg_coef=classifier_free_guidance,
+            )
 
-        model.lm.condition_provider.conditioners['self_wav'].chroma_coefficient = chroma_coefficient
+            sw.chroma_coefficient = chroma_coefficient
 
-        if not seed or seed == -1:
-            seed = torch.seed() % 2 ** 32 - 1
-        set_all_seeds(seed)
-        print(f"Using seed {seed}")
+            if not seed or seed == -1:
+                seed = torch.seed() % 2 ** 32 - 1
+            set_all_seeds(seed, deterministic=deterministic)
+            print(f"Using seed {seed}")
 
-        # Music Structure Analysis
-        music_input_analysis = allin1.analyze(music_input)
-
-        music_input, sr = torchaudio.load(music_input)
+            music_input_analysis = fut_analysis.result()
+        finally:
+            # allin1 must not be writing into the directory anymore when it's removed
+            if fut_analysis is not None and not fut_analysis.cancel():
+                wait([fut_analysis])
+            analysis_dir.cleanup()
 
         print("BPM : ", music_input_analysis.bpm)
         
@@ -277,161 +459,168 @@ class Predictor(BasePredictor):
         duration = music_input.shape[-1]/sr
         wav_sr = model.sample_rate
 
-        vocal, background = self.separate_vocals(music_input, sr)
-
-        audio_write(
-                "input_vocal",
-                vocal[0].cpu(),
-                model.sample_rate,
-                strategy=normalization_strategy,
-        )
+        # Everything below is eval only, inference tensors must not be modified outside of inference mode
+        with torch.inference_mode():
+            vocal, background, stems = self.separate_vocals(music_input, sr)
+
+            beat_sync_threshold = beat_sync_threshold
+            # amp_rate = amp_rate
+
+            set_generation_params(duration)
+
+            # Reuse the stems from `separate_vocals` instead of running demucs again for the chord conditioning
+            sw.cached_stems = stems
+            try:
+                wav, tokens = model.generate_with_chroma([prompt], music_input, sr, progress=True, return_tokens=True)
+            finally:
+                sw.cached_stems = None
+            if mbd is not None:
+                # Kept in fp32, the re-equalization in tokens_to_wav runs an FFT conv that half precision can't take
+                wav = mbd.tokens_to_wav(tokens)
+            wav = wav.float()
+
+            # Normalizing Audio, kept on the device until the single copy below
+            wav.nan_to_num_(nan=0.0, posinf=1.0, neginf=-1.0)
+            wav_amp = wav.abs().amax().clamp_min(1e-8)
+            wav.div_(wav_amp)
+            wav_cpu = wav.cpu()
+
+            vocal = vocal.cpu()
+            vocal_amp = vocal.abs().amax().clamp_min(1e-8).item()
+
+            if return_instrumental:
+                inst_path = audio_write(
+                        "background",
+                        wav_cpu[0],
+                        model.sample_rate,
+                        format=output_format,
+                        strategy=normalization_strategy,
+                )
+
+            wav_length = wav.shape[-1]
+
+
+            """Start Here"""
+            # if len(music_input_analysis.downbeats) > 0:
+
+            #     estimator = BeatNet.BeatNet(1, mode='offline', inference_model='DBN', plot=[], thread=False)
+            #     background_beat_estimation = estimator.process('background.wav')
+            #     background_estimated_downbeats = [beat[0] for beat in background_beat_estimation if beat[1] == 1.0] 
+            
+            #     input_beat_estimation = estimator.process(music_input)
+            #     input_estimated_downbeats = [beat[0] for beat in input_beat_estimation if beat[1] == 1.0] 
+
+            #     wav_downbeats = []
+            #     input_downbeats = []
+            #     for wav_beat in background_estimated_downbeats:
+            #         input_beat = min(input_estimated_downbeats, key=lambda x: abs(wav_beat - x), default=None)
+            #         if input_beat is None:
+            #             continue
+            #         print(wav_beat, input_beat)
+            #         if len(input_downbeats) != 0 and int(input_beat * wav_sr) == input_downbeats[-1]:
+            #             print('Dropped')
+            #             continue
+            #         if abs(wav_beat-input_beat)>beat_sync_threshold:
+            #             input_beat = wav_beat
+            #             print('Replaced')
+            #         wav_downbeats.append(int(wav_beat * wav_sr))
+            #         input_downbeats.append(int(input_beat * wav_sr))
+
+            #     downbeat_offset = input_downbeats[0]-wav_downbeats[0]
+            #     # print(downbeat_offset)
+            #     if downbeat_offset > 0:
+            #         wav = torch.concat([torch.zeros([1,channel,int(downbeat_offset)]).cpu(),wav.cpu()],dim=-1)
+            #         for i in range(len(wav_downbeats)):
+            #             wav_downbeats[i]=wav_downbeats[i]+downbeat_offset
+            #     wav_downbeats = [0] + wav_downbeats + [wav_length]
+            #     input_downbeats = [0] + input_downbeats + [wav_length]
+
+            #     # apply time stretching
+            #     wav = torch.Tensor(_wsola(wav[0].cpu().detach().numpy(), np.array([wav_downbeats, input_downbeats])))[...,:wav_length].unsqueeze(0).to(torch.float32)
+
+            #     # Normalizing Audio
+            #     mask_nan = torch.isnan(wav)
+            #     mask_inf = torch.isinf(wav)
+            #     wav[mask_nan] = 0
+            #     wav[mask_inf] = 1
+
+            #     wav_amp = wav.abs().max()
+            #     if wav_amp != 0:
+            #         wav = (wav/wav_amp).cpu()
+
+
+            #     audio_write(
+            #         "background_synced",
+            #         wav[0].cpu(),
+            #         model.sample_rate,
+            #         strategy=normalization_strategy,
+            #         loudness_compressor=True,
+            #     )
         
-        beat_sync_threshold = beat_sync_threshold
-        # amp_rate = amp_rate
-
-        set_generation_params(duration)
-
-        with torch.no_grad():
-            wav, tokens = model.generate_with_chroma([prompt], music_input, sr, progress=True, return_tokens=True)
-            if multi_band_diffusion:
-                wav = self.mbd.tokens_to_wav(tokens)
-
-        mask_nan = torch.isnan(wav)
-        mask_inf = torch.isinf(wav)
-
-        wav[mask_nan] = 0  
-        wav[mask_inf] = 1
-
-        wav_amp = wav.abs().max()
-        wav = (wav/wav_amp).cpu()
-        # print(wav.abs().max())
-
-        audio_write(
-                "background",
-                wav[0].cpu(),
+            # Mixing the generated background with the separated vocals
+            wav_length = min(wav_length, vocal.shape[-1])
+            # (wav + vocal/vocal_amp) * 0.25 with a single allocation for the output
+            output = torch.add(wav_cpu[0, :, :wav_length], vocal[0, :, :wav_length], alpha=1/vocal_amp).mul_(0.25)
+
+            # audio_write pipes straight into ffmpeg, so mp3 is encoded without an intermediate wav
+            path = audio_write(
+                "out",
+                output,
                 model.sample_rate,
+                format=output_format,
                 strategy=normalization_strategy,
-        )
-        
-        wav_length = wav.shape[-1]
-
-
-        """Start Here"""
-        # if len(music_input_analysis.downbeats) > 0:
-
-        #     estimator = BeatNet.BeatNet(1, mode='offline', inference_model='DBN', plot=[], thread=False)
-        #     background_beat_estimation = estimator.process('background.wav')
-        #     background_estimated_downbeats = [beat[0] for beat in background_beat_estimation if beat[1] == 1.0] 
-            
-        #     input_beat_estimation = estimator.process(music_input)
-        #     input_estimated_downbeats = [beat[0] for beat in input_beat_estimation if beat[1] == 1.0] 
-
-        #     wav_downbeats = []
-        #     input_downbeats = []
-        #     for wav_beat in background_estimated_downbeats:
-        #         input_beat = min(input_estimated_downbeats, key=lambda x: abs(wav_beat - x), default=None)
-        #         if input_beat is None:
-        #             continue
-        #         print(wav_beat, input_beat)
-        #         if len(input_downbeats) != 0 and int(input_beat * wav_sr) == input_downbeats[-1]:
-        #             print('Dropped')
-        #             continue
-        #         if abs(wav_beat-input_beat)>beat_sync_threshold:
-        #             input_beat = wav_beat
-        #             print('Replaced')
-        #         wav_downbeats.append(int(wav_beat * wav_sr))
-        #         input_downbeats.append(int(input_beat * wav_sr))
-
-        #     downbeat_offset = input_downbeats[0]-wav_downbeats[0]
-        #     # print(downbeat_offset)
-        #     if downbeat_offset > 0:
-        #         wav = torch.concat([torch.zeros([1,channel,int(downbeat_offset)]).cpu(),wav.cpu()],dim=-1)
-        #         for i in range(len(wav_downbeats)):
-        #             wav_downbeats[i]=wav_downbeats[i]+downbeat_offset
-        #     wav_downbeats = [0] + wav_downbeats + [wav_length]
-        #     input_downbeats = [0] + input_downbeats + [wav_length]
-
-        #     # apply time stretching
-        #     wav = torch.Tensor(tsm.wsola(wav[0].cpu().detach().numpy(), np.array([wav_downbeats, input_downbeats])))[...,:wav_length].unsqueeze(0).to(torch.float32)
-
-        #     # Normalizing Audio
-        #     mask_nan = torch.isnan(wav)
-        #     mask_inf = torch.isinf(wav)
-        #     wav[mask_nan] = 0
-        #     wav[mask_inf] = 1
-
-        #     wav_amp = wav.abs().max()
-        #     if wav_amp != 0:
-        #         wav = (wav/wav_amp).cpu()
-
-
-        #     audio_write(
-        #         "background_synced",
-        #         wav[0].cpu(),
-        #         model.sample_rate,
-        #         strategy=normalization_strategy,
-        #         loudness_compressor=True,
-        #     )
-        
-        wav = wav.to(torch.float32)
-
-        wav_amp = wav.abs().max()
-        vocal_amp = vocal.abs().max()
-
-        wav = 0.5*(wav/wav_amp).cpu()[...,:wav_length].cpu()*0.5
-
-        output = torch.zeros(2, wav.size())
-        output[0, :] = 0.5*(wav/wav_amp).cpu()[...,:wav_length].cpu()*0.5
-        output[1, :] = 0.5*(vocal/vocal_amp).cpu()[...,:wav_length].cpu()*0.5
-        
-        # Normalizing Audio
-        mask_nan = torch.isnan(wav)
-        mask_inf = torch.isinf(wav)
-
-        wav[mask_nan] = 0  
-        wav[mask_inf] = 1
-
-        wav_amp = wav.abs().max()
-        if wav_amp != 0:
-            wav = (wav/wav_amp).cpu()
-
-        audio_write(
-            "out",
-            output.cpu(),
-            model.sample_rate,
-            strategy=normalization_strategy,
-            loudness_compressor=True,
-        )
-        wav_path = "out.wav"
-
-        if output_format == "mp3":
-            mp3_path = "out.mp3"
-            if Path(mp3_path).exists():
-                os.remove(mp3_path)
-            subprocess.call(["ffmpeg", "-i", wav_path, mp3_path])
-            os.remove(wav_path)
-            path = mp3_path
-        else:
-            path = wav_path
+                loudness_compressor=True,
+            )
 
         output_dir = [Path(path)]
 
         if return_instrumental:
-            inst_path = "background_synced.wav"
-
-            if output_format == "mp3":
-                mp3_inst_path = "background_synced.mp3"
-                if Path(mp3_path).exists():
-                    os.remove(mp3_path)
-                subprocess.call(["ffmpeg", "-i", inst_path, mp3_inst_path])
-                os.remove(inst_path)
-                inst_out_path = mp3_inst_path
-            else:
-                inst_out_path = inst_path
-            output_dir.append(Path(inst_out_path))
+            output_dir.append(Path(inst_path))
 
         return output_dir
 
+    def _get_chord_state(self, model: MusicGen) -> dict:
+        chroma = model.lm.condition_provider.conditioners['self_wav'].chroma
+        return {
+            'large_voca': chroma.config.feature['large_voca'],
+            'num_chords': chroma.config.model['num_chords'],
+            'model_file': chroma.model_file,
+            'idx_to_chord': chroma.idx_to_chord,
+            'mean': chroma.mean,
+            'std': chroma.std,
+            'model': chroma.model,
+        }
+
+    def _set_chord_vocab(self, model_version: str, large_chord_voca: bool):
+        chroma = self.model.lm.condition_provider.conditioners['self_wav'].chroma
+        key = (model_version, large_chord_voca)
+        if key not in self._chord_cache:
+            # Switching Chord Prediction model to 25 vocab (smaller)
+            from audiocraft.modules.btc.btc_model import BTC_model
+            from audiocraft.modules.btc.utils.mir_eval_modules import idx2chord
+            config = chroma.config.model.copy()
+            config['num_chords'] = 25
+            loaded = torch.load('audiocraft/modules/btc/test/btc_model.pt')
+            btc = BTC_model(config=config).to(self.device)
+            btc.load_state_dict(loaded['model'])
+            self._chord_cache[key] = {
+                'large_voca': False,
+                'num_chords': 25,
+                'model_file': 'audiocraft/modules/btc/test/btc_model.pt',
+                'idx_to_chord': idx2chord,
+                'mean': loaded['mean'],
+                'std': loaded['std'],
+                'model': btc,
+            }
+        state = self._chord_cache[key]
+        chroma.config.feature['large_voca'] = state['large_voca']
+        chroma.config.model['num_chords'] = state['num_chords']
+        chroma.model_file = state['model_file']
+        chroma.idx_to_chord = state['idx_to_chord']
+        chroma.mean = state['mean']
+        chroma.std = state['std']
+        chroma.model = state['model']
+
     def _preprocess_audio(
         audio_path, model: MusicGen, duration: tp.Optional[int] = None
     ):
@@ -467,31 +656,43 @@ class Predictor(BasePredictor):
         return codes
 
     def estimate_beats(self, wav, sample_rate):
-        # resample to BeatNet's sample rate
-        beatnet_input = librosa.resample(
-            wav,
-            orig_sr=sample_rate,
-            target_sr=self.beatnet.sample_rate,
-        )
+        # resample to BeatNet's sample rate, reusing the resampling kernel per sample rate pair
+        key = (sample_rate, self.beatnet.sample_rate)
+        if key not in self._resamplers:
+            self._resamplers[key] = torchaudio.transforms.Resample(*key).to(self.device)
+        beatnet_input = self._resamplers[key](
+            torch.as_tensor(wav, dtype=torch.float32, device=self.device)
+        ).cpu().numpy()
         return self.beatnet.process(beatnet_input)
 
     def separate_vocals(self, music_input, sr):
         from demucs.audio import convert_audio
         from demucs.apply import apply_model
 
-        wav = convert_audio(music_input, sr, self.model.lm.condition_provider.conditioners['self_wav'].demucs.samplerate, self.model.lm.condition_provider.conditioners['self_wav'].demucs.audio_channels)
-        stems = apply_model(self.model.lm.condition_provider.conditioners['self_wav'].demucs, wav, device=self.device)
-        background = stems[:, self.model.lm.condition_provider.conditioners['self_wav'].demucs.sources.index('drums')] + stems[:, self.model.lm.condition_provider.conditioners['self_wav'].demucs.sources.index('other')] + stems[:, self.model.lm.condition_provider.conditioners['self_wav'].demucs.sources.index('bass')]
-        vocals = stems[:, self.model.lm.condition_provider.conditioners['self_wav'].demucs.sources.index('vocals')]
-        background = convert_audio(background, self.model.lm.condition_provider.conditioners['self_wav'].demucs.samplerate, self.model.sample_rate, 1)
-        vocals = convert_audio(vocals, self.model.lm.condition_provider.conditioners['self_wav'].demucs.samplerate, self.model.sample_rate, 1)
-        return vocals, background
+        demucs = self.model.lm.condition_provider.conditioners['self_wav'].demucs
+        wav = convert_audio(music_input, sr, demucs.samplerate, demucs.audio_channels)
+        stems = apply_model(demucs, wav, device=self.device)
+        if self._stem_idxs is None:
+            # every model version uses the same pretrained htdemucs, so the stem order is shared
+            sources = demucs.sources
+            self._stem_idxs = (
+                torch.tensor([sources.index(s) for s in ('drums', 'other', 'bass')]),
+                sources.index('vocals'),
+            )
+        bg_idxs, vocals_idx = self._stem_idxs
+        background = stems.index_select(1, bg_idxs.to(stems.device)).sum(dim=1)
+        vocals = stems[:, vocals_idx]
+        background = convert_audio(background, demucs.samplerate, self.model.sample_rate, 1)
+        vocals = convert_audio(vocals, demucs.samplerate, self.model.sample_rate, 1)
+        return vocals, background, stems
     
 # From https://gist.github.com/gatheluck/c57e2a40e3122028ceaecc3cb0d152ac
-def set_all_seeds(seed):
+def set_all_seeds(seed, deterministic=False):
     random.seed(seed)
     os.environ["PYTHONHASHSEED"] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
+    # Deterministic cuDNN disables the autotuner, so it's only enabled on request
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic